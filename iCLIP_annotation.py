@@ -0,0 +1,269 @@
+#!/usr/bin/python
+
+__author__  = 'Shan Sabri'
+__email__   = 'ShanASabri@gmail.com'
+__date__    = '2016/10/03'
+
+import datetime, argparse, os, sys, gzip, hashlib, shutil
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+start = datetime.datetime.now()
+
+###########---------------------------------------###########
+#
+# Build once, per GTF, an interval-indexed annotation cache shared by every
+# sample. The GTF is parsed into sorted NumPy arrays (0-based, half-open, BED
+# style) and saved as .npy files under <cache-directory>/<gtf>.<sha1>/. Loading
+# with mmap_mode='r' maps the same pages into every worker process, so jobs
+# never re-parse the GTF and forked workers share the arrays zero-copy.
+#
+# Usage example
+#
+# python iCLIP_annotation.py
+#     -gtf /u/home/s/ssabri/project-ernst/ref_data/Mus_musculus/UCSC/mm9/Annotation/Genes/genes.gtf
+#     --cache-directory /u/home/s/ssabri/scratch/annotation
+#
+# python iCLIP_annotation.py
+#     --cache /u/home/s/ssabri/scratch/annotation/genes.0123456789ab
+#     --peaks peaks/sample.trimmed.uniq.bed --outfile peaks/sample.trimmed.uniq.annotated.bed
+#
+###########---------------------------------------###########
+
+FEATURES = ('gene', 'exon')
+ARRAYS = ('chrom', 'start', 'end', 'strand', 'gene', 'max_end')
+STRANDS = {'+': 1, '-': -1, '.': 0}
+
+###########---------------------------------------###########
+
+def parse_user_args():
+    parser = argparse.ArgumentParser(description='Build or query a shared iCLIP annotation cache.')
+    parser.add_argument('-gtf', help='GTF file path, build (or reuse) its cache and print the cache path')
+    parser.add_argument('--cache-directory', default=os.getcwd(),
+                        help='directory holding annotation caches (default: current working directory)')
+    parser.add_argument('--cache', help='built annotation cache to annotate --peaks with')
+    parser.add_argument('--peaks', help='BED file of peaks or crosslinks to annotate')
+    parser.add_argument('--outfile', help='annotated BED output (default: stdout)')
+
+    args = parser.parse_args()
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        exit(1)
+
+    if not args.gtf and not (args.cache and args.peaks):
+        parser.error('either -gtf, or both --cache and --peaks, are required')
+
+    return args
+
+###########---------------------------------------###########
+
+def sha1sum(f, sha1=None):
+    sha1 = sha1 or hashlib.sha1()
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+        sha1.update(chunk)
+
+    return sha1
+
+def gtf_hash(gtf):
+    with open(gtf, 'rb') as f:
+        return sha1sum(f).hexdigest()
+
+def cache_path(gtf, cache_directory):
+    name = os.path.basename(gtf).split('.')[0]
+    return os.path.join(cache_directory, '{}.{}'.format(name, gtf_hash(gtf)[:12]))
+
+def transcriptome_index_path(gtf, cache_directory, ref):
+    # a sibling of the NumPy cache, keyed by GTF and reference, so neither build renames onto the other
+    ref = os.path.abspath(ref)
+    ref_key = '{}.{}'.format(os.path.basename(ref), hashlib.sha1(ref.encode('utf-8')).hexdigest()[:12])
+    return os.path.join(cache_path(gtf, cache_directory) + '.tophat2', ref_key)
+
+def is_transcriptome_index(path):
+    return os.path.exists(os.path.join(path, 'known.1.bt2'))
+
+def require_numpy():
+    if np is None:
+        raise ImportError('numpy is required to build or load an annotation cache')
+
+###########---------------------------------------###########
+
+def gene_id(attributes):
+    for field in attributes.split(';'):
+        field = field.strip()
+        if field.startswith('gene_id '):
+            return field[len('gene_id '):].strip('"')
+    return None
+
+def parse_gtf(gtf):
+    print('{}\tParsing {}'.format(datetime.datetime.now() - start, os.path.basename(gtf)))
+    opener = gzip.open if gtf.endswith('.gz') else open
+    exons = []
+    genes = {}
+    with opener(gtf, 'rt') as f:
+        for line in f:
+            if line.startswith('#'): continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 9 or fields[2] != 'exon': continue
+            gid = gene_id(fields[8])
+            if not gid: continue
+            chrom, s, e, strand = fields[0], int(fields[3]) - 1, int(fields[4]), fields[6]
+            exons.append((chrom, s, e, strand, gid))
+            # UCSC iGenomes GTFs carry no 'gene' lines and reuse gene symbols across
+            # contigs (chr1/chr1_random, chrX/chrY), so a gene spans its exons per contig and strand
+            key = (gid, chrom, strand)
+            if key in genes:
+                g = genes[key]
+                genes[key] = (min(g[0], s), max(g[1], e))
+            else:
+                genes[key] = (s, e)
+
+    genes = [(chrom, s, e, strand, gid) for (gid, chrom, strand), (s, e) in genes.items()]
+
+    return genes, exons
+
+###########---------------------------------------###########
+
+def index_intervals(rows, chroms, gene_ids):
+    rows = sorted(rows, key=lambda r: (chroms[r[0]], r[1], r[2]))
+    chrom = np.array([chroms[r[0]] for r in rows], dtype=np.int32)
+    s = np.array([r[1] for r in rows], dtype=np.int64)
+    e = np.array([r[2] for r in rows], dtype=np.int64)
+    strand = np.array([STRANDS.get(r[3], 0) for r in rows], dtype=np.int8)
+    gene = np.array([gene_ids[r[4]] for r in rows], dtype=np.int32)
+
+    # running max of end within each chromosome, non-decreasing, so the first
+    # interval that can still overlap a position is found by binary search
+    max_end = e.copy()
+    for c in np.unique(chrom):
+        idx = np.where(chrom == c)[0]
+        max_end[idx] = np.maximum.accumulate(e[idx])
+
+    return dict(zip(ARRAYS, (chrom, s, e, strand, gene, max_end)))
+
+def is_cache(path):
+    return os.path.exists(os.path.join(path, 'gene_ids.txt'))
+
+def build_cache(gtf, cache_directory):
+    require_numpy()
+    path = cache_path(gtf, cache_directory)
+    if is_cache(path):
+        print('{}\tUsing annotation cache {}'.format(datetime.datetime.now() - start, path))
+        return path
+
+    genes, exons = parse_gtf(gtf)
+    names = sorted(set(r[0] for r in exons))
+    chroms = dict((c, i) for i, c in enumerate(names))
+    ids = sorted(set(r[4] for r in exons))
+    gene_ids = dict((g, i) for i, g in enumerate(ids))
+
+    print('{}\tIndexing {} genes and {} exons'.format(datetime.datetime.now() - start, len(ids), len(exons)))
+    tables = {
+        'gene': index_intervals(genes, chroms, gene_ids),
+        'exon': index_intervals(exons, chroms, gene_ids),
+    }
+
+    # write to a scratch directory and rename, so concurrent jobs never see a half-built cache
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    if not os.path.exists(tmp): os.makedirs(tmp)
+    for feature in FEATURES:
+        for name in ARRAYS:
+            np.save(os.path.join(tmp, '{}.{}.npy'.format(feature, name)), tables[feature][name])
+    with open(os.path.join(tmp, 'chroms.txt'), 'w') as out: out.write('\n'.join(names) + '\n')
+    with open(os.path.join(tmp, 'gene_ids.txt'), 'w') as out: out.write('\n'.join(ids) + '\n')
+
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp)
+        if not is_cache(path):
+            raise IOError('{} exists but is not an annotation cache'.format(path))
+    print('{}\tWrote annotation cache {}'.format(datetime.datetime.now() - start, path))
+
+    return path
+
+###########---------------------------------------###########
+
+class Annotation(object):
+    def __init__(self, path):
+        require_numpy()
+        self.path = path
+        with open(os.path.join(path, 'chroms.txt')) as f: self.chroms = f.read().splitlines()
+        with open(os.path.join(path, 'gene_ids.txt')) as f: self.gene_ids = f.read().splitlines()
+        self.chrom_index = dict((c, i) for i, c in enumerate(self.chroms))
+        self.tables = {}
+        for feature in FEATURES:
+            table = dict((name, np.load(os.path.join(path, '{}.{}.npy'.format(feature, name)), mmap_mode='r'))
+                         for name in ARRAYS)
+            offsets = np.searchsorted(table['chrom'], np.arange(len(self.chroms) + 1))
+            self.tables[feature] = (table, offsets)
+
+    def overlapping(self, chrom, start, end=None, strand=None, feature='gene'):
+        # indices into the feature arrays of every interval overlapping the 0-based,
+        # half-open [start, end), or containing the single position start
+        end = start + 1 if end is None else end
+        if chrom not in self.chrom_index: return np.array([], dtype=np.int64)
+        table, offsets = self.tables[feature]
+        c = self.chrom_index[chrom]
+        lo, hi = offsets[c], offsets[c + 1]
+        first = lo + np.searchsorted(table['max_end'][lo:hi], start, side='right')
+        last = lo + np.searchsorted(table['start'][lo:hi], end, side='left')
+        idx = np.arange(first, last)
+        keep = table['end'][first:last] > start
+        if strand in ('+', '-'):
+            keep &= table['strand'][first:last] == STRANDS[strand]
+
+        return idx[keep]
+
+    def genes_at(self, chrom, start, end=None, strand=None):
+        table = self.tables['gene'][0]
+        genes = table['gene'][self.overlapping(chrom, start, end, strand)]
+        return sorted(set(self.gene_ids[g] for g in genes))
+
+    def in_exon(self, chrom, start, end=None, strand=None):
+        return len(self.overlapping(chrom, start, end, strand, feature='exon')) > 0
+
+    def region(self, chrom, start, end=None, strand=None):
+        if self.in_exon(chrom, start, end, strand): return 'exon'
+        if len(self.overlapping(chrom, start, end, strand)): return 'intron'
+        return 'intergenic'
+
+def load_cache(path):
+    return Annotation(path)
+
+###########---------------------------------------###########
+
+def annotate_peaks(annotation, peaks, out):
+    # append the overlapping gene ids and exon/intron/intergenic region to each BED record
+    counts = dict.fromkeys(('exon', 'intron', 'intergenic'), 0)
+    with open(peaks) as f:
+        for line in f:
+            if line.startswith(('track', 'browser', '#')): continue
+            fields = line.rstrip('\n').split('\t')
+            chrom, s, e = fields[0], int(fields[1]), int(fields[2])
+            strand = fields[5] if len(fields) > 5 else None
+            genes = annotation.genes_at(chrom, s, e, strand)
+            region = annotation.region(chrom, s, e, strand)
+            counts[region] += 1
+            out.write('\t'.join(fields + [','.join(genes) or '.', region]) + '\n')
+
+    return counts
+
+###########---------------------------------------###########
+
+if __name__ == '__main__':
+    args = parse_user_args()
+    if args.gtf:
+        if not os.path.exists(args.cache_directory): os.makedirs(args.cache_directory)
+        print(build_cache(args.gtf, args.cache_directory))
+    else:
+        annotation = load_cache(args.cache)
+        out = open(args.outfile, 'w') if args.outfile else sys.stdout
+        counts = annotate_peaks(annotation, args.peaks, out)
+        if args.outfile: out.close()
+        sys.stderr.write('{}\t{} exon, {} intron, {} intergenic peaks in {}\n'.format(
+            datetime.datetime.now() - start, counts['exon'], counts['intron'], counts['intergenic'],
+            os.path.basename(args.peaks)))
@@ -52,6 +52,9 @@ def parse_user_args():
                           help='a space-seperated list of arguments for GSNAP (default: -t 4 -N 1 --max-mismatches=0 -A sam --gunzip)')
     parser.add_argument('--clipper-args', nargs='+', type=str,
                         help='a space-seperated list of arguments for CLIPPER (default: --premRNA --bonferroni)')
+    parser.add_argument('-gtf', help='GTF file path, annotate CLIPPER peaks with overlapping genes and regions (requires numpy)')
+    parser.add_argument('--annotation-cache', default=None,
+                        help='directory holding shared, per-GTF annotation caches (default: <fq-directory>/../annotation)')
 
     args = parser.parse_args()
 
@@ -124,11 +127,19 @@ source ~/.bash_profile
     -s {args.genome} \
     {clipper_args} \
     --outfile {peaks}
-
+{annotate}
 # CLEAN UP
 rm {clean_up}
 """
 
+ANNOTATE_TEMPLATE = """
+# ANNOTATE PEAKS
+{python} {annotation_script} \
+    --cache {annotation} \
+    --peaks {peaks} \
+    --outfile {annotated_peaks}
+"""
+
 ###########---------------------------------------###########
 
 if __name__ == '__main__':
@@ -154,6 +165,15 @@ if __name__ == '__main__':
     else:
         clipper_args = '--premRNA --bonferroni'
 
+    if args.gtf:
+        # parse the GTF once here, every job maps the same cache read-only
+        from iCLIP_annotation import build_cache
+        annotation_cache = args.annotation_cache or os.path.join(os.path.dirname(args.fq_directory), 'annotation')
+        if not os.path.exists(annotation_cache): os.makedirs(annotation_cache)
+        annotation = build_cache(args.gtf, annotation_cache)
+        annotation_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'iCLIP_annotation.py')
+        python = sys.executable
+
     for f in fastqs:
         print '{}\tGenerating pipeline for {}'.format(datetime.datetime.now() - start, os.path.basename(f))
         clean_up = []
@@ -166,6 +186,8 @@ if __name__ == '__main__':
         flagstats = os.path.basename(f.replace(".fq.gz", ".stats.txt"))
         peaks = f.replace('.fq.gz', '.bed')
         peaks = peaks.replace('fastq', 'peaks')
+        annotated_peaks = peaks.replace('.bed', '.annotated.bed')
+        annotate = ANNOTATE_TEMPLATE.format(**globals()) if args.gtf else ''
         clean_up.extend((aligned_sam, aligned_bam))
         clean_up = ' '.join(clean_up)
 
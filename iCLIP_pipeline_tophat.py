@@ -4,7 +4,8 @@ __author__  = 'Shan Sabri'
 __email__   = 'ShanASabri@gmail.com'
 __date__    = '2016/10/03'
 
-import datetime, argparse, os, sys
+import datetime, argparse, os, sys, shutil
+from iCLIP_annotation import transcriptome_index_path, is_transcriptome_index
 
 start = datetime.datetime.now()
 
@@ -35,6 +36,10 @@ def parse_user_args():
                         help='the number of threads to use for alignment (default: %(default)s)')
     parser.add_argument('--run-time', type=int, default=24,
                         help='node compute time in hours needed for Hoffman2 (default: %(default)s hours)')
+    parser.add_argument('--annotation-cache', default=None,
+                        help='directory holding shared, per-GTF annotation caches; the TopHat2 transcriptome index is built there '
+                             'once, by running tophat2 on this host before any job script is written '
+                             '(default: <fq-directory>/../annotation)')
 
     args = parser.parse_args()
 
@@ -56,6 +61,38 @@ def init_dir(dirname):
 
 ###########---------------------------------------###########
 
+def init_transcriptome_index(tophat2, args, cache_directory):
+    # built once per GTF and reference and shared by every sample, instead of each job re-parsing -G
+    path = transcriptome_index_path(args.gtf, cache_directory, args.ref_directory)
+    index = os.path.join(path, 'known')
+    if is_transcriptome_index(path):
+        print '{}\tUsing transcriptome index {}'.format(datetime.datetime.now()-start, index)
+        return index
+
+    # build under a scratch directory and rename, so an interrupted or concurrent build is never reused
+    print '{}\tBuilding transcriptome index {}'.format(datetime.datetime.now()-start, index)
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    if not os.path.exists(tmp): os.makedirs(tmp)
+    status = os.system('{} -G {} --transcriptome-index={} -o {} {}'.format(tophat2, args.gtf,
+                                                                          os.path.join(tmp, 'known'),
+                                                                          os.path.join(tmp, 'out'),
+                                                                          args.ref_directory))
+    if status != 0:
+        shutil.rmtree(tmp)
+        sys.exit('Building the transcriptome index failed (exit status {})'.format(status))
+    shutil.rmtree(os.path.join(tmp, 'out'), ignore_errors=True)
+
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp)
+        if not is_transcriptome_index(path):
+            sys.exit('{} exists but is not a transcriptome index'.format(path))
+
+    return index
+
+###########---------------------------------------###########
+
 SCRIPT_TEMPLATE = """\
 #!/bin/bash
 source ~/.bash_profile
@@ -69,7 +106,7 @@ source ~/.bash_profile
 # ALIGN
 {tophat2} \
     {tophat2_args} \
-    -G {args.gtf} \
+    --transcriptome-index={transcriptome_index} \
     -o {out} \
     {args.ref_directory} \
     {f} \
@@ -92,6 +129,11 @@ if __name__ == '__main__':
     samtools = os.popen('which samtools').readline().strip()
     tophat2 = os.popen('which tophat2').readline().strip()
     clipper = os.popen('which clipper').readline().strip()
+    if not tophat2: sys.exit('tophat2 was not found on the PATH')
+
+    annotation_cache = args.annotation_cache or os.path.join(os.path.dirname(args.fq_directory), 'annotation')
+    if not os.path.exists(annotation_cache): os.makedirs(annotation_cache)
+    transcriptome_index = init_transcriptome_index(tophat2, args, annotation_cache)
 
     tophat2_args = '--num-threads {} --library-type fr-unstranded -N 0 -a 4 -x 1 -g 1 --no-coverage-search'.format(args.num_threads)
     clipper_args = '--premRNA --bonferroni'
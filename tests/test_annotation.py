@@ -0,0 +1,111 @@
+import os, pytest
+
+np = pytest.importorskip('numpy')
+import iCLIP_annotation
+
+# GTF coordinates are 1-based inclusive; the cache stores 0-based half-open
+# A: chr1 [10, 20) + [30, 40) on +, B: chr1 [14, 100) on -, C: chr2 [0, 5) on +,
+# D: chr1 [200, 210) on + and chr1_random [0, 10) on + (same gene_id on two contigs)
+GTF = """\
+#!genome-build mm9
+chr1\tx\texon\t11\t20\t.\t+\t.\tgene_id "A"; transcript_id "a";
+chr1\tx\texon\t31\t40\t.\t+\t.\tgene_id "A"; transcript_id "a";
+chr1\tx\texon\t15\t100\t.\t-\t.\tgene_id "B"; transcript_id "b";
+chr2\tx\texon\t1\t5\t.\t+\t.\tgene_id "C"; transcript_id "c";
+chr1\tx\texon\t201\t210\t.\t+\t.\tgene_id "D"; transcript_id "d";
+chr1_random\tx\texon\t1\t10\t.\t+\t.\tgene_id "D"; transcript_id "d";
+"""
+
+@pytest.fixture
+def annotation(tmp_path):
+    gtf = tmp_path / 'genes.gtf'
+    gtf.write_text(GTF)
+    path = iCLIP_annotation.build_cache(str(gtf), str(tmp_path))
+    return iCLIP_annotation.load_cache(path)
+
+def test_half_open_boundaries(annotation):
+    assert annotation.genes_at('chr1', 9) == []
+    assert annotation.genes_at('chr1', 10) == ['A']
+    assert annotation.genes_at('chr1', 99) == ['B']
+    assert annotation.genes_at('chr1', 100) == []
+    assert annotation.genes_at('chr1', 5, 10) == []
+    assert annotation.genes_at('chr1', 5, 11) == ['A']
+
+def test_running_max_end(annotation):
+    # B starts after A but ends far beyond it, so positions past A's end still find B
+    assert annotation.genes_at('chr1', 25) == ['A', 'B']
+    assert annotation.genes_at('chr1', 50) == ['B']
+    assert annotation.genes_at('chr1', 150) == []
+
+def test_strand_and_region(annotation):
+    assert annotation.genes_at('chr1', 25, strand='+') == ['A']
+    assert annotation.region('chr1', 25, strand='+') == 'intron'
+    assert annotation.region('chr1', 25, strand='-') == 'exon'
+    assert annotation.region('chr1', 150) == 'intergenic'
+
+def test_unknown_and_empty_chromosomes(annotation):
+    assert annotation.genes_at('chr3', 0) == []
+    assert not annotation.in_exon('chr3', 0)
+    assert annotation.genes_at('chr2', 0, strand='-') == []
+
+def test_gene_on_two_contigs(annotation):
+    # spans are kept per contig, rather than one bogus span from chr1_random's start to chr1's end
+    assert annotation.genes_at('chr1', 205) == ['D']
+    assert annotation.genes_at('chr1_random', 5) == ['D']
+    assert annotation.genes_at('chr1', 5) == []
+
+def test_cache_is_reused(tmp_path):
+    gtf = tmp_path / 'genes.gtf'
+    gtf.write_text(GTF)
+    path = iCLIP_annotation.build_cache(str(gtf), str(tmp_path))
+    mtime = os.path.getmtime(os.path.join(path, 'gene_ids.txt'))
+    assert iCLIP_annotation.build_cache(str(gtf), str(tmp_path)) == path
+    assert os.path.getmtime(os.path.join(path, 'gene_ids.txt')) == mtime
+
+def test_invalid_existing_cache_directory(tmp_path):
+    gtf = tmp_path / 'genes.gtf'
+    gtf.write_text(GTF)
+    path = iCLIP_annotation.cache_path(str(gtf), str(tmp_path))
+    os.makedirs(os.path.join(path, 'leftover'))
+    with pytest.raises(IOError):
+        iCLIP_annotation.build_cache(str(gtf), str(tmp_path))
+
+def test_annotate_peaks(annotation, tmp_path):
+    peaks = tmp_path / 'peaks.bed'
+    peaks.write_text('track name=peaks\nchr1\t20\t28\tp1\t0\t+\nchr1\t150\t160\tp2\t0\t-\n')
+    out = tmp_path / 'peaks.annotated.bed'
+    with open(str(out), 'w') as f:
+        counts = iCLIP_annotation.annotate_peaks(annotation, str(peaks), f)
+    assert counts == {'exon': 0, 'intron': 1, 'intergenic': 1}
+    assert out.read_text().splitlines() == ['chr1\t20\t28\tp1\t0\t+\tA\tintron',
+                                            'chr1\t150\t160\tp2\t0\t-\t.\tintergenic']
+
+def test_gene_ids_round_trip(tmp_path):
+    # an empty gene_id is skipped and one containing a space stays one id, so gene indices line up
+    gtf = tmp_path / 'genes.gtf'
+    gtf.write_text('chr1\tx\texon\t1\t5\t.\t+\t.\tgene_id ""; transcript_id "a";\n'
+                   'chr1\tx\texon\t11\t15\t.\t+\t.\tgene_id "B"; transcript_id "b";\n'
+                   'chr1\tx\texon\t21\t25\t.\t+\t.\tgene_id "C c"; transcript_id "c";\n'
+                   'chr1\tx\texon\t31\t35\t.\t+\t.\tgene_id "D"; transcript_id "d";\n')
+    annotation = iCLIP_annotation.load_cache(iCLIP_annotation.build_cache(str(gtf), str(tmp_path)))
+    assert annotation.genes_at('chr1', 2) == []
+    assert annotation.genes_at('chr1', 12) == ['B']
+    assert annotation.genes_at('chr1', 22) == ['C c']
+    assert annotation.genes_at('chr1', 32) == ['D']
+
+def make_transcriptome_index(gtf, cache_directory):
+    path = iCLIP_annotation.transcriptome_index_path(gtf, cache_directory, '/ref/mm9/genome')
+    os.makedirs(path)
+    open(os.path.join(path, 'known.1.bt2'), 'w').close()
+    return path
+
+@pytest.mark.parametrize('tophat2_first', [True, False])
+def test_cache_and_transcriptome_index_coexist(tmp_path, tophat2_first):
+    gtf = tmp_path / 'genes.gtf'
+    gtf.write_text(GTF)
+    if tophat2_first: index = make_transcriptome_index(str(gtf), str(tmp_path))
+    path = iCLIP_annotation.build_cache(str(gtf), str(tmp_path))
+    if not tophat2_first: index = make_transcriptome_index(str(gtf), str(tmp_path))
+    assert iCLIP_annotation.is_cache(path)
+    assert iCLIP_annotation.is_transcriptome_index(index)
+    assert iCLIP_annotation.load_cache(path).genes_at('chr1', 10) == ['A']